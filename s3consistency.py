@@ -7,9 +7,11 @@
 # 3. read_after_overwrite: Read an object after it has been overwritten
 # 4. list_after_create: List objects after an object has been created
 # 5. list_after_delete: List objects after an object has been deleted
+# 6. head_after_create: Head an object after it has been created
 # The script takes the following arguments:
 # --iterations: Number of iteration per thread per test. Default is 5.
 # --threads: Number threads per test. Default is 5.
+# --processes: Number of worker processes per test. Default is 1 (threads only).
 # --chunk-size: Size in bytes of created files. Default is 1.
 # --endpoint: S3 endpoint to use. Default is https://objectstore.basefarm.com.
 # --region: S3 region to use. Default is us-east-1.
@@ -18,134 +20,349 @@
 # The script logs the results to /var/log/s3consistency.log.
 # This script runs default against the Orange/Basefarm Object Store. To run against a different S3 object store, update the AWS credentials as environment variables and provide the endpoint and region as arguments.
 
-import boto3
+import functools
+import io
 import logging
-import uuid
+import multiprocessing
+import queue
+import random
+import secrets
+import time
 import threading
 import argparse
 import os
 import config
-from botocore.exceptions import NoCredentialsError, PartialCredentialsError
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from logging.handlers import QueueHandler, QueueListener
+# botocore.exceptions must stay at module scope: the @backoff(...) decorator
+# arguments need the exception classes when the module is imported.
+from botocore.exceptions import ClientError, EndpointConnectionError, NoCredentialsError, PartialCredentialsError, ReadTimeoutError
 
 # Define the AWS credentials as environment variables
 # export AWS_ACCESS_KEY_ID='your_access_key_id'
 # export AWS_SECRET_ACCESS_KEY='your_secret_access_key'
 
+logger = logging.getLogger(__name__)
 
-def initialize_s3_client(endpoint, region):
-    session = boto3.Session()
-    s3_client = session.client('s3', endpoint_url=endpoint, region_name=region)
-    return s3_client
+# boto3 clients are only conditionally thread-safe, so each worker thread gets
+# its own client stored in a thread-local instead of sharing one client.
+_tls = threading.local()
 
-def create_random_file(client, bucket, chunk_size, key=None):
+# Creating a boto3 Session loads the service JSON models (~25 ms each time),
+# so build it once on first use and share it across all clients. Importing
+# boto3 here rather than at module top keeps the ~200 ms package import off
+# the cold-start path for callers that never touch S3 (e.g. --help).
+@functools.lru_cache(maxsize=None)
+def _session():
+    import boto3
+    return boto3.Session()
+
+
+def _build_s3_client(endpoint, region, max_pool_connections=10):
+    from botocore.config import Config
+
+    client_config = Config(
+        signature_version='s3v4',
+        # Floor of 50 keeps a warm keep-alive socket per in-flight request
+        # even at low thread counts, avoiding "Connection pool is full"
+        # discards and repeated TCP+TLS handshakes.
+        max_pool_connections=max(max_pool_connections, 50),
+        tcp_keepalive=True,
+        parameter_validation=False,
+        endpoint_discovery_enabled=False,
+        retries={'max_attempts': 10, 'mode': 'adaptive'},
+    )
+    return _session().client('s3', endpoint_url=endpoint, region_name=region, config=client_config)
+
+
+@functools.lru_cache(maxsize=None)
+def initialize_s3_client(endpoint, region, max_pool_connections=10):
+    return _build_s3_client(endpoint, region, max_pool_connections)
+
+def get_client(endpoint, region, max_pool_connections=10):
+    client = getattr(_tls, 'client', None)
+    if client is None:
+        # Deliberately bypasses the lru_cache: each worker thread needs its
+        # own client, not the shared memoized one.
+        client = _build_s3_client(endpoint, region, max_pool_connections)
+        _tls.client = client
+    return client
+
+# Error codes that indicate transient endpoint trouble rather than an actual
+# consistency signal; anything else (NoSuchKey, AccessDenied, ...) must reach
+# the test logic untouched.
+_RETRYABLE_ERROR_CODES = ('InternalError', 'ServiceUnavailable', 'SlowDown', '500', '503')
+
+def backoff(exceptions, max_tries=5, base=0.05, jitter=0.5):
+    """Retry the wrapped probe on transient errors with exponential backoff.
+
+    Delays grow as base * 2**attempt with random jitter so retrying workers
+    do not synchronize into a thundering herd against a saturated endpoint.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            for attempt in range(max_tries):
+                try:
+                    return fn(*args, **kwargs)
+                except exceptions as e:
+                    if isinstance(e, ClientError) and e.response['Error']['Code'] not in _RETRYABLE_ERROR_CODES:
+                        raise
+                    if attempt == max_tries - 1:
+                        raise
+                    delay = base * (2 ** attempt) * (1 + random.random() * jitter)
+                    logger.debug(f"Retrying {fn.__name__} in {delay:.3f}s after {type(e).__name__} (attempt {attempt + 1}/{max_tries})")
+                    time.sleep(delay)
+        return wrapper
+    return decorator
+
+# Payloads at or above this size are streamed instead of held in memory.
+_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+
+@functools.lru_cache(maxsize=None)
+def _transfer_config():
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(multipart_threshold=_MULTIPART_THRESHOLD, multipart_chunksize=_MULTIPART_THRESHOLD, max_concurrency=8, use_threads=True)
+
+
+class ZeroReader(io.RawIOBase):
+    """Seekable file-like object yielding `size` NUL bytes without allocating them all."""
+
+    def __init__(self, size):
+        self._size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = self._size + offset
+        return self._pos
+
+    def readinto(self, b):
+        n = min(len(b), max(self._size - self._pos, 0))
+        b[:n] = bytes(n)
+        self._pos += n
+        return n
+
+
+def _make_payload(chunk_size):
+    # Small payloads are shared immutable buffers; large ones are kept as a
+    # size and streamed per PUT so memory stays bounded at the part size.
+    if chunk_size >= _MULTIPART_THRESHOLD:
+        return chunk_size
+    return bytes(chunk_size)
+
+def _as_body(payload):
+    return ZeroReader(payload) if isinstance(payload, int) else payload
+
+def _random_key():
+    # ~3x cheaper than uuid.uuid4() and fixed-length, so one key can never be
+    # a prefix of another (the listing probes match on Prefix=key).
+    return secrets.token_hex(8)
+
+def create_random_file(client, bucket, body, key=None):
     if key is None:
-        key = str(uuid.uuid4())
-    body = bytes([0] * chunk_size)
-    client.put_object(Bucket=bucket, Key=key, Body=body)
-    logger.info(f"PUT object {key}")
+        key = _random_key()
+    if isinstance(body, int):
+        # s3transfer splits the stream into parts and uploads them
+        # concurrently, so even a 5 GB object never sits in client memory.
+        client.upload_fileobj(ZeroReader(body), bucket, key, Config=_transfer_config())
+    else:
+        client.put_object(Bucket=bucket, Key=key, Body=body)
+    logger.debug(f"PUT object {key}")
     return key
 
-def list_after_delete(client, bucket, iterations, chunk_size):
-    count = 0
-    total = 0
-    for _ in range(iterations):
-        key = create_random_file(client, bucket, chunk_size)
-        client.delete_object(Bucket=bucket, Key=key)
-        logger.info(f"DELETE object {key}")
-        response = client.list_objects_v2(Bucket=bucket)
-        found = any(obj['Key'] == key for obj in response.get('Contents', []))
-        if found:
-            count += 1
-            logger.info(f"Got a listAfterDelete error, expected {key} file is still listed")
-        total += 1
-    logger.info(f"listAfterDelete {count}/{total} failed")
-    return count
-
-def list_after_create(client, bucket, iterations, chunk_size):
-    count = 0
-    total = 0
-    for _ in range(iterations):
-        key = create_random_file(client, bucket, chunk_size)
-        response = client.list_objects_v2(Bucket=bucket)
-        found = any(obj['Key'] == key for obj in response.get('Contents', []))
-        if not found:
-            count += 1
-            logger.info(f"Got a listAfterCreate error, expected {key} file not listed")
-        client.delete_object(Bucket=bucket, Key=key)
-        total += 1
-    logger.info(f"listAfterCreate {count}/{total} failed")
-    return count
-
-def read_after_overwrite(client, bucket, iterations, chunk_size):
-    count = 0
-    total = 0
-    for _ in range(iterations):
-        key = create_random_file(client, bucket, chunk_size)
-        create_random_file(client, bucket, chunk_size + 1, key)
-        response = client.get_object(Bucket=bucket, Key=key)
-        body = response['Body'].read()
-        if len(body) != chunk_size + 1:
-            count += 1
-            logger.info(f"Got a readAfterOverwrite error, expected {chunk_size+1} bytes, got {len(body)} instead")
-        client.delete_object(Bucket=bucket, Key=key)
-        total += 1
-    return count
-
-def read_after_delete(client, bucket, iterations, chunk_size):
-    count = 0
-    total = 0
-    for _ in range(iterations):
-        key = create_random_file(client, bucket, chunk_size)
-        client.delete_object(Bucket=bucket, Key=key)
-        try:
-            client.get_object(Bucket=bucket, Key=key)
-        except client.exceptions.NoSuchKey:
-            pass
+@backoff((EndpointConnectionError, ReadTimeoutError, ClientError))
+def list_after_delete(client, bucket, key, body, body_over):
+    create_random_file(client, bucket, body, key)
+    client.delete_object(Bucket=bucket, Key=key)
+    logger.debug(f"DELETE object {key}")
+    # Prefix + MaxKeys=1 makes the server do the membership check instead of
+    # returning up to 1000 unrelated keys per probe.
+    response = client.list_objects_v2(Bucket=bucket, Prefix=key, MaxKeys=1)
+    if response.get('Contents'):
+        logger.info(f"Got a listAfterDelete error, expected {key} file is still listed")
+        return 1
+    return 0
+
+@backoff((EndpointConnectionError, ReadTimeoutError, ClientError))
+def list_after_create(client, bucket, key, body, body_over):
+    create_random_file(client, bucket, body, key)
+    response = client.list_objects_v2(Bucket=bucket, Prefix=key, MaxKeys=1)
+    errors = 0
+    if not response.get('Contents'):
+        errors = 1
+        logger.info(f"Got a listAfterCreate error, expected {key} file not listed")
+    client.delete_object(Bucket=bucket, Key=key)
+    return errors
+
+@backoff((EndpointConnectionError, ReadTimeoutError, ClientError))
+def read_after_overwrite(client, bucket, key, body, body_over):
+    create_random_file(client, bucket, body, key)
+    response = client.put_object(Bucket=bucket, Key=key, Body=_as_body(body_over))
+    logger.debug(f"PUT object {key}")
+    # Condition the GET on the overwrite's ETag: the server does the version
+    # check, so a stale read surfaces as 412 Precondition Failed instead of
+    # the client downloading and length-checking the body.
+    etag = response['ETag']
+    errors = 0
+    try:
+        response = client.get_object(Bucket=bucket, Key=key, IfMatch=etag)
+        response['Body'].close()
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'PreconditionFailed':
+            raise
+        errors = 1
+        logger.info(f"Got a readAfterOverwrite error, {key} did not match the overwrite ETag {etag}")
+    client.delete_object(Bucket=bucket, Key=key)
+    return errors
+
+@backoff((EndpointConnectionError, ReadTimeoutError, ClientError))
+def read_after_delete(client, bucket, key, body, body_over):
+    create_random_file(client, bucket, body, key)
+    client.delete_object(Bucket=bucket, Key=key)
+    try:
+        client.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        return 0
+    return 1
+
+@backoff((EndpointConnectionError, ReadTimeoutError, ClientError))
+def read_after_create(client, bucket, key, body, body_over):
+    create_random_file(client, bucket, body, key)
+    errors = 0
+    try:
+        client.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        errors = 1
+    client.delete_object(Bucket=bucket, Key=key)
+    return errors
+
+@backoff((EndpointConnectionError, ReadTimeoutError, ClientError))
+def head_after_create(client, bucket, key, body, body_over):
+    # Same probe as read_after_create but via HEAD: only presence is checked,
+    # so skipping the response body makes the round-trip cheaper.
+    create_random_file(client, bucket, body, key)
+    errors = 0
+    try:
+        client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            errors = 1
         else:
-            count += 1
-        total += 1
-    return count
-
-def read_after_create(client, bucket, iterations, chunk_size):
-    count = 0
-    total = 0
-    for _ in range(iterations):
-        key = create_random_file(client, bucket, chunk_size)
-        try:
-            client.get_object(Bucket=bucket, Key=key)
-        except client.exceptions.NoSuchKey:
-            count += 1
-        client.delete_object(Bucket=bucket, Key=key)
-        total += 1
-    return count
-
-def run_test(client, bucket, fn, iterations, threads, chunk_size):
-    errors = []
-    def target():
-        errors.append(fn(client, bucket, iterations, chunk_size))
-    
-    threads = [threading.Thread(target=target) for _ in range(threads)]
-    for thread in threads:
-        thread.start()
-    for thread in threads:
-        thread.join()
-    
-    err_count = sum(errors)
-    err_pct = (err_count / (iterations * len(threads))) * 100.0
-    logger.info(f"{fn.__name__:30} | {iterations * len(threads):10} | {err_count:6} | {err_pct:8.4f}")
+            raise
+    client.delete_object(Bucket=bucket, Key=key)
+    return errors
+
+# Per-process state for --processes mode, set up by _init_worker in each
+# worker so clients and payloads are never pickled across the process boundary.
+_worker_client = None
+_worker_bodies = None
+
+def _init_worker(endpoint, region, max_pool_connections, chunk_size, bucket, log_queue, log_level):
+    global _worker_client, _worker_bodies
+    # Any handlers inherited via fork wrap the parent's in-process log queue,
+    # which no listener drains on this side, so records sent to them vanish.
+    # Replace them with a handler on the multiprocessing queue that run_test
+    # drains in the parent, keeping the per-key diagnostics in the log file.
+    root_logger = logging.getLogger()
+    root_logger.handlers = [QueueHandler(log_queue)]
+    root_logger.setLevel(log_level)
+    _worker_client = _build_s3_client(endpoint, region, max_pool_connections)
+    _worker_bodies = (_make_payload(chunk_size), _make_payload(chunk_size + 1))
+    # Connectivity precheck that also opens a keep-alive socket, so the first
+    # timed probe in this process runs at steady-state latency.
+    _worker_client.head_bucket(Bucket=bucket)
+
+def _run_worker_op(fn, bucket, key):
+    body, body_over = _worker_bodies
+    return fn(_worker_client, bucket, key, body, body_over)
+
+def run_test(endpoint, region, bucket, fn, iterations, threads, chunk_size, processes=1):
+    total_ops = iterations * threads
+    # Pre-generate keys and share one payload per size so the timed section
+    # measures S3 latency rather than client-side key/body construction.
+    keys = [_random_key() for _ in range(total_ops)]
+
+    if processes > 1:
+        # Process workers sidestep the GIL during response parsing; each
+        # process gets its own client via the initializer. Their log records
+        # travel over a managed queue (a plain multiprocessing.Queue cannot be
+        # pickled into initargs) to a listener here that forwards them to this
+        # process's handlers.
+        root_logger = logging.getLogger()
+        with multiprocessing.Manager() as manager:
+            log_queue = manager.Queue()
+            log_listener = QueueListener(log_queue, *root_logger.handlers, respect_handler_level=True)
+            log_listener.start()
+            try:
+                with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(endpoint, region, threads, chunk_size, bucket, log_queue, root_logger.getEffectiveLevel())) as executor:
+                    futures = [executor.submit(_run_worker_op, fn, bucket, key) for key in keys]
+                    err_count = sum(future.result() for future in as_completed(futures))
+            finally:
+                log_listener.stop()
+    else:
+        body = _make_payload(chunk_size)
+        body_over = _make_payload(chunk_size + 1)
+
+        def run_single_op(key):
+            client = get_client(endpoint, region, max_pool_connections=threads)
+            return fn(client, bucket, key, body, body_over)
+
+        def warm_up():
+            get_client(endpoint, region, max_pool_connections=threads).head_bucket(Bucket=bucket)
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            # One head_bucket per worker thread opens the keep-alive sockets
+            # (and verifies connectivity) before the timed ops start, so the
+            # first probe per thread is as fast as the steady-state ones.
+            for future in [executor.submit(warm_up) for _ in range(threads)]:
+                future.result()
+            futures = [executor.submit(run_single_op, key) for key in keys]
+            err_count = sum(future.result() for future in as_completed(futures))
+
+    err_pct = (err_count / total_ops) * 100.0
+    logger.info(f"{fn.__name__:30} | {total_ops:10} | {err_count:6} | {err_pct:8.4f}")
 
     return err_count
 
 def clean_up(client, bucket):
-    response = client.list_objects_v2(Bucket=bucket)
-    for obj in response.get('Contents', []):
-        client.delete_object(Bucket=bucket, Key=obj['Key'])
-        logger.info(f"DELETE object {obj['Key']}")
+    # delete_objects accepts up to 1000 keys per call, so page through the
+    # bucket and delete in batches instead of one round-trip per key.
+    paginator = client.get_paginator('list_objects_v2')
+    batch = []
+    for page in paginator.paginate(Bucket=bucket):
+        for obj in page.get('Contents', []):
+            batch.append({'Key': obj['Key']})
+            if len(batch) == 1000:
+                client.delete_objects(Bucket=bucket, Delete={'Objects': batch})
+                logger.info(f"DELETE batch of {len(batch)} objects")
+                batch = []
+    if batch:
+        client.delete_objects(Bucket=bucket, Delete={'Objects': batch})
+        logger.info(f"DELETE batch of {len(batch)} objects")
 
 def main():
     parser = argparse.ArgumentParser(description="S3 consistency tests")
     parser.add_argument("--iterations", type=int, default=5, help="Number of iteration per thread per test.")
     parser.add_argument("--threads", type=int, default=5, help="Number threads per test.")
+    parser.add_argument("--processes", type=int, default=1, help="Number of worker processes per test. Values above 1 bypass the GIL for large fan-outs.")
     parser.add_argument("--chunk-size", type=int, default=1, help="Size in bytes of created files")
     parser.add_argument("--endpoint", type=str, default="https://objectstore.basefarm.com", help="S3 endpoint to use")
     parser.add_argument("--region", type=str, default="us-east-1", help="S3 region to use")
@@ -162,21 +379,27 @@ def main():
 
     config.load_s3_credentials()
 
-    client = initialize_s3_client(args.endpoint, args.region)
     bucket_name = args.bucket
 
     if args.clean:
+        client = initialize_s3_client(args.endpoint, args.region)
         clean_up(client, bucket_name)
         return
 
-    test_results = []
+    tests = [
+        ("read_after_delete", read_after_delete),
+        ("read_after_create", read_after_create),
+        ("head_after_create", head_after_create),
+        ("read_after_overwrite", read_after_overwrite),
+        ("list_after_create", list_after_create),
+        ("list_after_delete", list_after_delete),
+    ]
 
-    # Run the tests and collect results
-    test_results.append(("read_after_delete", run_test(client, bucket_name, read_after_delete, args.iterations, args.threads, args.chunk_size)))
-    test_results.append(("read_after_create", run_test(client, bucket_name, read_after_create, args.iterations, args.threads, args.chunk_size)))
-    test_results.append(("read_after_overwrite", run_test(client, bucket_name, read_after_overwrite, args.iterations, args.threads, args.chunk_size)))
-    test_results.append(("list_after_create", run_test(client, bucket_name, list_after_create, args.iterations, args.threads, args.chunk_size)))
-    test_results.append(("list_after_delete", run_test(client, bucket_name, list_after_delete, args.iterations, args.threads, args.chunk_size)))
+    # The tests are independent (every op uses its own random key), so probe
+    # the endpoint with all of them concurrently instead of back-to-back.
+    with ThreadPoolExecutor(max_workers=len(tests)) as executor:
+        futures = {name: executor.submit(run_test, args.endpoint, args.region, bucket_name, fn, args.iterations, args.threads, args.chunk_size, args.processes) for name, fn in tests}
+        test_results = [(name, future.result()) for name, future in futures.items()]
 
     # Print the summary of results
     print("\nSummary of Results:")
@@ -188,13 +411,23 @@ def main():
         print(f"{test_name:30} | {total_iterations:10} | {error_count:6} | {error_pct:8.4f}")
 
 if __name__ == "__main__":
-    # Configure logging
-    logging.basicConfig(filename=f"/var/log/s3consistency.log", level=logging.DEBUG, datefmt='%Y-%m-%d %H:%M:%S', format="[%(asctime)s] %(filename)s in %(funcName)s(), line %(lineno)d (%(levelname)s): %(message)s")
+    # Configure logging. Worker threads hand records to an in-memory queue and
+    # a dedicated listener thread does the file I/O, so the per-handler lock
+    # never serializes the test threads on disk writes.
+    file_handler = logging.FileHandler("/var/log/s3consistency.log")
+    file_handler.setFormatter(logging.Formatter(datefmt='%Y-%m-%d %H:%M:%S', fmt="[%(asctime)s] %(filename)s in %(funcName)s(), line %(lineno)d (%(levelname)s): %(message)s"))
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, file_handler)
+    listener.start()
+    logging.getLogger().setLevel(logging.INFO)
+    logging.getLogger().addHandler(QueueHandler(log_queue))
     logging.getLogger("boto3").setLevel(logging.WARNING)
     logging.getLogger("threading").setLevel(logging.WARNING)
     logging.getLogger("argparse").setLevel(logging.WARNING)
     logging.getLogger("os").setLevel(logging.WARNING)
-    logger = logging.getLogger(__name__)
     logger.info(" <------------------SCRIPT START------------------>")
-    main()
-    logger.info(" <------------------ SCRIPT END ------------------>")
+    try:
+        main()
+    finally:
+        logger.info(" <------------------ SCRIPT END ------------------>")
+        listener.stop()